@@ -17,6 +17,7 @@ This module defines the main LDAP authentication plug-in.
 
 import logging
 import re
+from itertools import islice
 
 from beaker.cache import cache_region
 from ldap3 import ALL, ALL_ATTRIBUTES, ASYNC, AUTO_BIND_DEFAULT, AUTO_BIND_NONE, BASE, Connection, \
@@ -32,13 +33,14 @@ from zope.schema.fieldproperty import FieldProperty
 from pyams_auth_ldap.interfaces import ILDAPGroupInfo, ILDAPPlugin, ILDAPUserInfo, \
     INTERNAL_GROUP_MAIL_MODE, NO_GROUP_MAIL_MODE, QUERY_MEMBERS_FROM_GROUP
 from pyams_auth_ldap.query import LDAPQuery
-from pyams_auth_ldap.utils import get_formatted_value, get_single_value
+from pyams_auth_ldap.utils import get_formatted_value, get_list_values, get_single_value
 from pyams_mail.interfaces import IPrincipalMailInfo
 from pyams_security.interfaces.names import PRINCIPAL_ID_FORMATTER
 from pyams_security.principal import PrincipalInfo
 from pyams_utils.adapter import ContextAdapter, adapter_config
 from pyams_utils.factory import factory_config
 from pyams_utils.registry import query_utility
+from pyams_utils.request import get_request_data, query_request, set_request_data
 
 
 __docformat__ = 'restructuredtext'
@@ -152,6 +154,20 @@ class LDAPGroupMailInfoAdapter(ContextAdapter):
 
 LDAP_MANAGERS = {}
 
+LDAP_CONNECTIONS_KEY = 'pyams_auth_ldap.connections'
+
+
+def get_request_connections(request):
+    """Get LDAP connections bound with plug-ins credentials for given request
+
+    Result is a mapping of connections, indexed by plug-in ID.
+    """
+    connections = get_request_data(request, LDAP_CONNECTIONS_KEY)
+    if connections is None:
+        connections = {}
+        set_request_data(request, LDAP_CONNECTIONS_KEY, connections)
+    return connections
+
 
 class ConnectionManager:
     """LDAP connections manager"""
@@ -305,20 +321,46 @@ class LDAPPlugin(Persistent, Contained):
         self_id = self._get_id()
         if self_id in LDAP_MANAGERS:
             del LDAP_MANAGERS[self_id]
+        request = query_request()
+        if request is not None:
+            get_request_connections(request).pop(self_id, None)
 
     def get_connection(self, user=None, password=None):
-        """Connection getter"""
+        """Connection getter
+
+        When no credentials are provided, the connection bound with plug-in credentials is
+        stored into current request, so that it's only bound once per request.
+        """
         self_id = self._get_id()
         if self_id not in LDAP_MANAGERS:
             LDAP_MANAGERS[self_id] = self.connection_manager_class(self)
+        manager = LDAP_MANAGERS[self_id]
         if not (user and password):
+            request = query_request()
+            if request is not None:
+                return self._get_request_connection(request, self_id, manager)
             user = self.bind_dn
             password = self.bind_password
-        connection = LDAP_MANAGERS[self_id].get_connection(user, password)
+        connection = manager.get_connection(user, password)
         if connection.closed:
             connection.open(read_server_info=False)
         return connection
 
+    def _get_request_connection(self, request, self_id, manager):
+        """Get connection bound with plug-in credentials for given request"""
+        connections = get_request_connections(request)
+        connection = connections.get(self_id)
+        if (connection is None) or connection.closed:
+            # a closed connection is not reopened, because it would not be bound again
+            connection = manager.get_connection(self.bind_dn, self.bind_password)
+            if connection.closed:
+                connection.open(read_server_info=False)
+            connections[self_id] = connection
+            if connection.strategy_type != REUSABLE:
+                # shared reusable connection is kept open by connections manager
+                request.add_finished_callback(lambda req: connection.unbind())
+        return connection
+
     def authenticate(self, credentials, request):  # pylint: disable=unused-argument
         """Authenticate provided credentials"""
         if not self.enabled:
@@ -578,20 +620,39 @@ class LDAPPlugin(Persistent, Contained):
                                                   **group_attrs),
                         dn=group_dn)
 
-    def get_search_results(self, data):
-        """Search results getter"""
-        # LDAP search results are made of tuples containing DN and all
-        # entries attributes
-        query = data.get('query')
+    def get_search_results(self, data=None, query=None, attributes=None, limit=None):
+        """Search results getter
+
+        Search query can be provided as *query* argument, or as *data* mapping item
+        as required by directory search plug-ins interface.
+
+        If *limit* is provided, users and groups searches are each limited to this number
+        of results; results are returned in server order, so they are not sorted before
+        being limited.
+        """
+        # LDAP search results are made of tuples containing DN and given
+        # entries attributes (or all attributes if none are provided), whose
+        # values are always lists; paged search is used so that results are
+        # streamed from the LDAP server
+        if query is None and data:
+            query = data.get('query')
         if not query:
             return
+        if not attributes:
+            attributes = ALL_ATTRIBUTES
         conn = self.get_connection()
         # users search
-        search = LDAPQuery(self.base_dn, self.users_search_query,
-                           self.search_scope, ALL_ATTRIBUTES)
-        yield from search.execute(conn, query=query)
+        searches = [
+            LDAPQuery(self.base_dn, self.users_search_query,
+                      self.search_scope, attributes)
+        ]
         # groups search
         if self.groups_base_dn:
-            search = LDAPQuery(self.groups_base_dn, self.groups_search_query,
-                               self.groups_search_scope, ALL_ATTRIBUTES)
-            yield from search.execute(conn, query=query)
+            searches.append(LDAPQuery(self.groups_base_dn, self.groups_search_query,
+                                      self.groups_search_scope, attributes))
+        for search in searches:
+            results = search.execute_paged(conn, query=query)
+            if limit:
+                results = islice(results, limit)
+            for entry_dn, attrs in results:
+                yield entry_dn, get_list_values(attrs)
@@ -18,20 +18,26 @@ This module provides a simple wrapper to handle LDAP queries.
 
 import logging
 
+from ldap3 import REUSABLE
+
 
 __docformat__ = 'restructuredtext'
 
 LOGGER = logging.getLogger('PyAMS (ldap)')
 
+DEFAULT_PAGE_SIZE = 200
+PAGED_RESULTS_CONTROL = '1.2.840.113556.1.4.319'
+
 
 class LDAPQuery:
     """Object representing an LDAP query"""
 
-    def __init__(self, base_dn, filter_tmpl, scope, attributes):
+    def __init__(self, base_dn, filter_tmpl, scope, attributes, size_limit=0):
         self.base_dn = base_dn.strip()
         self.filter_tmpl = filter_tmpl
         self.scope = scope
         self.attributes = attributes
+        self.size_limit = size_limit
 
     def __str__(self):
         return ('base_dn={base_dn}, filter_tmpl={filter_tmpl}, '
@@ -44,6 +50,7 @@ class LDAPQuery:
         LOGGER.debug(f"  >      args: {kwargs}")
         ret = conn.search(search_scope=self.scope,
                           attributes=self.attributes,
+                          size_limit=self.size_limit,
                           *key)
         result, status, request = conn.get_response(ret, get_request=True)
         LOGGER.debug(f"  > LDAP request: {request}")
@@ -58,3 +65,39 @@ class LDAPQuery:
             ]
         LOGGER.debug(f"<<< LDAP result: {result}")
         return result
+
+    def execute_paged(self, conn, paged_size=DEFAULT_PAGE_SIZE, **kwargs):
+        """Execute an LDAP query using paged results
+
+        Results are returned by an iterator, so that only the current page of results
+        is kept in memory; entries are returned in server order.
+
+        Paged results cookies are bound to the LDAP connection which issued them, so
+        paged search is not used on pooled (reusable) connections, where successive
+        requests can be sent to different connections.
+        """
+        if conn.strategy_type == REUSABLE:
+            yield from self.execute(conn, **kwargs)
+            return
+        key = (self.base_dn.format(**kwargs), self.filter_tmpl.format(**kwargs))
+        LOGGER.debug(f">>> LDAP paged query: {self.filter_tmpl} (base {self.base_dn})")
+        LOGGER.debug(f"  >      args: {kwargs}")
+        cookie = None
+        while True:
+            ret = conn.search(search_scope=self.scope,
+                              attributes=self.attributes,
+                              size_limit=self.size_limit,
+                              paged_size=paged_size,
+                              paged_cookie=cookie,
+                              *key)
+            result, status = conn.get_response(ret)
+            LOGGER.debug(f"  < LDAP status: {status}")
+            for entry in result or ():
+                if 'dn' in entry:
+                    yield entry['dn'], entry['attributes']
+            try:
+                cookie = status['controls'][PAGED_RESULTS_CONTROL]['value']['cookie']
+            except (KeyError, TypeError):
+                cookie = None
+            if not cookie:
+                break
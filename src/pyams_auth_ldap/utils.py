@@ -27,6 +27,14 @@ def get_single_value(entry):
     return str(entry)
 
 
+def get_list_values(entries: dict):
+    """Convert given entries values to lists, in place"""
+    for key, value in entries.items():
+        if not isinstance(value, list):
+            entries[key] = list(value) if isinstance(value, tuple) else [value]
+    return entries
+
+
 def get_dict_values(entries: dict, attributes: list):
     """Get given attributes from entries"""
     values = {}
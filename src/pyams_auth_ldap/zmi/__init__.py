@@ -15,13 +15,17 @@
 This module defines view and content providers used to manage LDAP directory plug-ins.
 """
 
-import base64
+import binascii
+import html
+from operator import itemgetter
+from urllib.parse import quote_plus
 
 from ldap3 import ALL_ATTRIBUTES, BASE
 from pyramid.decorator import reify
 from zope.interface import Interface, implementer
 
 from pyams_auth_ldap.interfaces import ILDAPPlugin, LDAP_PLUGIN_LABEL
+from pyams_auth_ldap.plugin import DN_ATTRIBUTE
 from pyams_auth_ldap.query import LDAPQuery
 from pyams_auth_ldap.utils import get_single_value
 from pyams_auth_ldap.zmi.interfaces import ILDAPPluginConnectionSubform, \
@@ -44,6 +48,7 @@ from pyams_table.column import GetAttrColumn
 from pyams_table.interfaces import IColumn, IValues
 from pyams_utils.adapter import ContextRequestViewAdapter, adapter_config
 from pyams_utils.registry import get_utility
+from pyams_utils.request import get_request_data, set_request_data
 from pyams_utils.url import absolute_url
 from pyams_viewlet.viewlet import viewlet_config
 from pyams_zmi.form import AdminModalDisplayForm
@@ -61,6 +66,29 @@ __docformat__ = 'restructuredtext'
 from pyams_auth_ldap import _  # pylint: disable=ungrouped-imports
 
 
+#
+# LDAP plug-in fields
+#
+
+_CONNECTION_FIELDS = Fields(ILDAPPlugin).select('server_uri', 'start_tls',
+                                                'bind_dn', 'bind_password', 'bind_mode')
+
+_USERS_FIELDS = Fields(ILDAPPlugin).select('base_dn', 'search_scope', 'login_attribute',
+                                           'login_query', 'uid_attribute', 'uid_query',
+                                           'title_format', 'mail_attribute',
+                                           'user_extra_attributes')
+
+_GROUPS_FIELDS = Fields(ILDAPPlugin).select('groups_base_dn', 'groups_search_scope', 'group_prefix',
+                                            'group_uid_attribute', 'group_title_format',
+                                            'group_members_query_mode', 'groups_query',
+                                            'group_members_attribute', 'user_groups_attribute',
+                                            'group_mail_mode', 'group_replace_expression',
+                                            'group_mail_attribute', 'group_extra_attributes')
+
+_SEARCH_FIELDS = Fields(ILDAPPlugin).select('users_select_query', 'users_search_query',
+                                            'groups_select_query', 'groups_search_query')
+
+
 #
 # LDAP plug-in add form
 #
@@ -110,10 +138,7 @@ class LDAPPluginUsersSchemaAddForm(InnerAddForm):
 
     title = _("Users schema")
 
-    fields = Fields(ILDAPPlugin).select('base_dn', 'search_scope', 'login_attribute',
-                                        'login_query', 'uid_attribute', 'uid_query',
-                                        'title_format', 'mail_attribute',
-                                        'user_extra_attributes')
+    fields = _USERS_FIELDS
     weight = 10
 
 
@@ -125,12 +150,7 @@ class LDAPPluginGroupsSchemaAddForm(InnerAddForm):
 
     title = _("Groups schema")
 
-    fields = Fields(ILDAPPlugin).select('groups_base_dn', 'groups_search_scope', 'group_prefix',
-                                        'group_uid_attribute', 'group_title_format',
-                                        'group_members_query_mode', 'groups_query',
-                                        'group_members_attribute', 'user_groups_attribute',
-                                        'group_mail_mode', 'group_replace_expression',
-                                        'group_mail_attribute', 'group_extra_attributes')
+    fields = _GROUPS_FIELDS
     weight = 20
 
 
@@ -142,8 +162,7 @@ class LDAPPluginSearchSettingsAddForm(InnerAddForm):
 
     title = _("Search settings")
 
-    fields = Fields(ILDAPPlugin).select('users_select_query', 'users_search_query',
-                                        'groups_select_query', 'groups_search_query')
+    fields = _SEARCH_FIELDS
     weight = 30
 
 
@@ -176,10 +195,7 @@ class LDAPPluginUsersSchemaEditForm(InnerEditForm):
 
     title = _("Users schema")
 
-    fields = Fields(ILDAPPlugin).select('base_dn', 'search_scope', 'login_attribute',
-                                        'login_query', 'uid_attribute', 'uid_query',
-                                        'title_format', 'mail_attribute',
-                                        'user_extra_attributes')
+    fields = _USERS_FIELDS
     weight = 10
 
 
@@ -191,12 +207,7 @@ class LDAPPluginGroupsSchemaEditForm(InnerEditForm):
 
     title = _("Groups schema")
 
-    fields = Fields(ILDAPPlugin).select('groups_base_dn', 'groups_search_scope', 'group_prefix',
-                                        'group_uid_attribute', 'group_title_format',
-                                        'group_members_query_mode', 'groups_query',
-                                        'group_members_attribute', 'user_groups_attribute',
-                                        'group_mail_mode', 'group_replace_expression',
-                                        'group_mail_attribute', 'group_extra_attributes')
+    fields = _GROUPS_FIELDS
     weight = 20
 
 
@@ -208,8 +219,7 @@ class LDAPPluginSearchSettingsEditForm(InnerEditForm):
 
     title = _("Search settings")
 
-    fields = Fields(ILDAPPlugin).select('users_select_query', 'users_search_query',
-                                        'groups_select_query', 'groups_search_query')
+    fields = _SEARCH_FIELDS
     weight = 30
 
 
@@ -221,38 +231,28 @@ class LDAPPluginSearchSettingsEditForm(InnerEditForm):
                 provides=IFormFields)
 def ldap_plugin_connection_fields(context, request, view):  # pylint: disable=unused-argument
     """LDAP plugin connection fields"""
-    return Fields(ILDAPPlugin).select('server_uri', 'start_tls',
-                                      'bind_dn', 'bind_password', 'bind_mode')
+    return _CONNECTION_FIELDS
 
 
 @adapter_config(required=(Interface, IAdminLayer, ILDAPPluginUsersSchemaSubform),
                 provides=IFormFields)
 def ldap_plugin_users_schema_fields(context, request, view):  # pylint: disable=unused-argument
     """LDAP plugin users schema fields"""
-    return Fields(ILDAPPlugin).select('base_dn', 'search_scope', 'login_attribute',
-                                      'login_query', 'uid_attribute', 'uid_query',
-                                      'title_format', 'mail_attribute',
-                                      'user_extra_attributes')
+    return _USERS_FIELDS
 
 
 @adapter_config(required=(Interface, IAdminLayer, ILDAPPluginGroupsSchemaSubform),
                 provides=IFormFields)
 def ldap_plugin_groups_schema_fields(context, request, view):  # pylint: disable=unused-argument
     """LDAP plugin groups schema fields"""
-    return Fields(ILDAPPlugin).select('groups_base_dn', 'groups_search_scope', 'group_prefix',
-                                      'group_uid_attribute', 'group_title_format',
-                                      'group_members_query_mode', 'groups_query',
-                                      'group_members_attribute', 'user_groups_attribute',
-                                      'group_mail_mode', 'group_replace_expression',
-                                      'group_mail_attribute', 'group_extra_attributes')
+    return _GROUPS_FIELDS
 
 
 @adapter_config(required=(Interface, IAdminLayer, ILDAPPluginSearchSettingsSubform),
                 provides=IFormFields)
 def ldap_plugin_search_settings_fields(context, request, view):  # pylint: disable=unused-argument
     """LDAP plugin search settings fields"""
-    return Fields(ILDAPPlugin).select('users_select_query', 'users_search_query',
-                                      'groups_select_query', 'groups_search_query')
+    return _SEARCH_FIELDS
 
 #
 # LDAP folder search view
@@ -286,35 +286,77 @@ class LDAPPluginSearchResultsTable(Table):
     def data_attributes(self):
         attributes = super().data_attributes
         attributes.setdefault('tr', {}).update({
-            'data-ams-url': lambda row, col: absolute_url(self.context, self.request,
-                                                          'ldap-properties.html',
-                                                          query={'dn': row[0]}),
+            'data-ams-url': self.get_row_url,
             'data-toggle': 'modal'
         })
         return attributes
 
     batch_size = 999
 
+    @reify
+    def properties_url(self):
+        """LDAP entry properties view base URL"""
+        return absolute_url(self.context, self.request, 'ldap-properties.html')
+
+    def get_row_url(self, row, col):  # pylint: disable=unused-argument
+        """LDAP entry properties view URL getter"""
+        return f'{self.properties_url}?dn={quote_plus(row[0])}'
+
+    @reify
+    def cells_cache(self):
+        """Rendered cells cache
+
+        This cache is a mapping indexed by row, whose values are mappings of rendered
+        attributes values indexed by attribute name.
+        """
+        return {}
+
+    @reify
+    def search_results(self):
+        """LDAP search results iterator"""
+        plugin = self.context
+        attributes = [
+            attr
+            for attr in (plugin.uid_attribute, 'cn', 'mail')
+            if attr != DN_ATTRIBUTE
+        ]
+        return plugin.get_search_results(query=self.request.params.get('form.widgets.query'),
+                                         attributes=attributes,
+                                         limit=self.batch_size)
+
 
 @adapter_config(required=(ILDAPPlugin, IAdminLayer, LDAPPluginSearchResultsTable),
                 provides=IValues)
 class LDAPPluginSearchResultsValues(ContextRequestViewAdapter):
     """LDAP plug-in search results values"""
 
-    @property
+    @reify
     def values(self):
-        """LDAP plug-in search table results getter"""
-        yield from self.context.get_search_results({
-            'query': self.request.params.get('form.widgets.query')
-        })
+        """LDAP plug-in search table results getter
+
+        Users and groups searches are each limited to *batch_size* results; results are
+        limited in LDAP server order, before being sorted by the table.
+        """
+        return list(self.view.search_results)
+
+
+def escape_value(value):
+    """Get HTML-escaped string value of given LDAP attribute value"""
+    return html.escape(get_single_value(value))
 
 
 class LDAPColumn(I18nColumnMixin, GetAttrColumn):
     """Base LDAP column"""
 
     def get_value(self, obj):
-        value = obj[1].get(self.attr_name, ())
-        return '<br /> '.join(value) if isinstance(value, (list, tuple)) else value
+        row_cache = self.table.cells_cache.setdefault(id(obj), {})
+        attr_name = self.attr_name
+        value = row_cache.get(attr_name)
+        if value is None:
+            # search results attributes values are always lists
+            value = row_cache[attr_name] = '<br />'.join(map(escape_value,
+                                                             obj[1].get(attr_name, ())))
+        return value
 
 
 @adapter_config(name='uid',
@@ -325,8 +367,9 @@ class LDAPPluginSearchUIDColumn(LDAPColumn):
 
     i18n_header = _("UID")
 
-    @property
+    @reify
     def attr_name(self):
+        """Attribute name getter"""
         return self.context.uid_attribute
 
     weight = 10
@@ -369,6 +412,56 @@ class LDAPPluginSearchResultsView(SearchResultsView):
 # LDAP entry display view
 #
 
+PHOTO_ATTRIBUTES = {'jpegPhoto', 'thumbnailPhoto'}
+
+
+def get_photo_image(photo):
+    """Get HTML image of given photo attribute value, using a base64 data URL"""
+    if isinstance(photo, list):
+        if not photo:
+            return ''
+        photo = photo[0]
+    encoded = binascii.b2a_base64(photo, newline=False).decode('ascii')
+    return f'<img src="data:image/jpeg;base64,{encoded}" />'
+
+
+LDAP_ENTRY_CACHE_KEY = 'pyams_auth_ldap.entry'
+
+
+def get_ldap_entry(plugin, request):
+    """Get LDAP entry matching request DN
+
+    Entry is stored into request annotations, so that the LDAP directory is queried only
+    once per request, whatever the number of components using it.
+    """
+    dn = request.params.get('dn')  # pylint: disable=invalid-name
+    cache = get_request_data(request, LDAP_ENTRY_CACHE_KEY)
+    if cache is None:
+        cache = {}
+        set_request_data(request, LDAP_ENTRY_CACHE_KEY, cache)
+    key = (id(plugin), dn)
+    entry = cache.get(key)
+    if entry is None:
+        entry = cache[key] = _get_ldap_entry(plugin, dn)
+    return entry
+
+
+def _get_ldap_entry(plugin, dn):  # pylint: disable=invalid-name
+    """Load LDAP entry matching given DN"""
+    conn = plugin.get_connection()
+    # a single entry is expected, so don't let the server return more than two
+    query = LDAPQuery(dn, '(objectclass=*)', BASE, ALL_ATTRIBUTES, size_limit=2)
+    result = query.execute(conn)
+    if not result or len(result) > 1:
+        return {}
+    dn, attributes = result[0]  # pylint: disable=invalid-name
+    result = sorted(attributes.items(), key=itemgetter(0))
+    return {
+        'dn': dn,
+        'attributes': result
+    }
+
+
 @pagelet_config(name='ldap-properties.html',
                 context=ILDAPPlugin, layer=IPyAMSLayer,
                 permission=MANAGE_SECURITY_PERMISSION)
@@ -380,38 +473,10 @@ class LDAPEntryPropertiesDisplayForm(AdminModalDisplayForm):
     legend = _("LDAP entry attributes")
     fields = Fields(Interface)
 
-    @reify
+    @property
     def ldap_entry(self):
         """LDAP entry getter"""
-        plugin = self.context
-        conn = plugin.get_connection()
-        dn = self.request.params.get('dn')  # pylint: disable=invalid-name
-        query = LDAPQuery(dn, '(objectclass=*)', BASE, ALL_ATTRIBUTES)
-        result = query.execute(conn)
-        if not result or len(result) > 1:
-            return {}
-        dn, attributes = result[0]  # pylint: disable=invalid-name
-        photo = attributes.get('jpegPhoto')
-        if photo is not None:
-            if isinstance(photo, list):
-                photo = photo[0]
-            attributes['jpegPhoto'] = [
-                '<img src="data:image/jpeg;base64,{0}" />'.format(
-                    base64.encodebytes(photo).decode())
-            ]
-        photo = attributes.get('thumbnailPhoto')
-        if photo is not None:
-            if isinstance(photo, list):
-                photo = photo[0]
-            attributes['thumbnailPhoto'] = [
-                '<img src="data:image/jpeg;base64,{0}" />'.format(
-                    base64.encodebytes(photo).decode())
-            ]
-        result = sorted(attributes.items(), key=lambda x: x[0])
-        return {
-            'dn': dn,
-            'attributes': result
-        }
+        return get_ldap_entry(self.context, self.request)
 
 
 @adapter_config(required=(ILDAPPlugin, IAdminLayer, LDAPEntryPropertiesDisplayForm),
@@ -419,9 +484,10 @@ class LDAPEntryPropertiesDisplayForm(AdminModalDisplayForm):
 def ldap_entry_display_form_title(context, request, form):
     """LDAP entry display form title getter"""
     translate = request.localizer.translate
+    entry = get_ldap_entry(context, request)
     return TITLE_SPAN_BREAK.format(
         get_object_label(context, request, form),
-        translate(_("DN: {}")).format(form.ldap_entry.get('dn', _('unknown'))))
+        translate(_("DN: {}")).format(entry.get('dn', _('unknown'))))
 
 
 @viewlet_config(name='entry-properties',
@@ -445,10 +511,10 @@ class LDAPEntryPropertiesTable(Table):
 class LDAPEntryPropertiesTableValues(ContextRequestViewAdapter):
     """LDAP entry properties table values"""
 
-    @property
+    @reify
     def values(self):
         """LDAP entry attributes getter"""
-        yield from self.view.view.ldap_entry.get('attributes', ())
+        return list(get_ldap_entry(self.context, self.request).get('attributes', ()))
 
 
 @adapter_config(name='attribute',
@@ -475,4 +541,8 @@ class LDAPEntryValuesColumn(I18nColumnMixin, GetAttrColumn):
 
     def get_value(self, obj):
         """Value getter"""
-        return get_single_value(obj[1])
+        name, value = obj
+        if name in PHOTO_ATTRIBUTES:
+            # photos are only encoded when rendered
+            return get_photo_image(value)
+        return get_single_value(value)